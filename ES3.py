@@ -1,13 +1,19 @@
 import streamlit as st
-import pandas as pd
 import plotly.graph_objects as go
-import mesa
 import json
-import math
-import time
 import datetime
+import threading
+import time
+import uuid
+import os
+import hashlib
+import io
+import gzip
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-from openai import OpenAI
+# 仿真内核 (mesa) 与 pandas 均在使用处延迟导入，浏览 Core/Market/About 不加载
+from espark_llm import LLM_ROUTING, LLMRouter, create_llm_backends, reachable_backends, INTERACTIVE, BATCH
 
 # ==============================================================================
 # 1. 页面配置与 CSS (严格保持侧边栏 320px 设计)
@@ -116,82 +122,380 @@ st.markdown("""
 # ==============================================================================
 if 'simulation_history' not in st.session_state:
     st.session_state.simulation_history = [] 
+if 'active_jobs' not in st.session_state:
+    st.session_state.active_jobs = []
+if 'session_id' not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex
 
-class StrategicAgent(mesa.Agent):
-    def __init__(self, unique_id, model):
-        super().__init__(unique_id, model)
-        self.policy_stage = 0 
-        self.policy_names = ["严格一孩", "试点(双独/单独)", "全面二孩", "三孩及配套"]
-        
-    def step(self):
-        year = self.model.year
-        current_pol = self.policy_names[self.policy_stage]
-        economy_context = self.model.get_economic_context(year)
-        labor_status = self.model.get_labor_supply_status(year)
-        grassroots = self.model.get_grassroots_feedback(year)
-        
-        thought = "模拟推演中..."
-        new_stage = self.policy_stage
-
-        if self.model.api_key:
-            try:
-                if year % 2 == 0 or year > 2010:
-                    user_prompt = f"""
-                    【年份】{year} 【国策】{current_pol}
-                    【情报】经济:{economy_context} | 劳动力:{labor_status} | 基层:{grassroots}
-                    【任务】决定明年政策(0-3)。
-                    【输出JSON】{{"thought": "...", "decision_code": int}}
-                    """
-                    client = OpenAI(api_key=self.model.api_key, base_url="https://api.deepseek.com")
-                    response = client.chat.completions.create(
-                        model="deepseek-chat",
-                        messages=[{"role": "system", "content": self.model.system_prompt}, {"role": "user", "content": user_prompt}],
-                        temperature=self.model.temperature, max_tokens=300
-                    )
-                    content = response.choices[0].message.content.replace("```json", "").replace("```", "").strip()
-                    result = json.loads(content)
-                    new_stage = int(result["decision_code"])
-                    thought = result["thought"]
-            except Exception as e:
-                thought = f"AI Error: {e}"
+# 决策者人设预设：名称 -> (System Prompt, 默认温度)
+PERSONAS = {
+    "稳健型 (历史真实)": ("你是一个对历史负责的战略家。深知'人口政策有20年滞后性'。坚持民主集中制，不被短期民意裹挟。", 0.3),
+    "激进改革型": ("你是一个极具前瞻性的改革家。高度关注'20年后的劳动力危机'，一旦发现异常，宁可牺牲当下经济也要提前改革。", 0.7),
+    "僵化保守型": ("你是一个短视的决策者。只关注当下的GDP增长，完全忽略20年后的劳动力隐患。", 0.1),
+}
+
+# --- 后台任务队列：推演在工作线程中运行，不受页面交互/切换影响 ---
+class SimulationJob:
+    def __init__(self, config, key=None, owner=None, priority=INTERACTIVE):
+        self.id = uuid.uuid4().hex[:8]
+        self.config = config
+        self.key = key
+        self.owner = owner        # 发起会话，用于限流调度的会话间公平轮转
+        self.priority = priority
+        self.llm = None
+        self.subscribers = 1  # 共享同一计算的会话数
+        self.cached = False
+        self.status = "queued"  # queued / running / done / error / cancelled
+        self.error = None
+        self.rows = list(config.get("prefix_rows", []))
+        self.checkpoints = list(config.get("prefix_checkpoints", []))
+        self.final_state = None   # 末年之后的模型状态，用于越过原终点续跑
+        self.finished_at = None   # 结束时间，超时未被领取的任务由 JobManager 清理
+        self.cancel_requested = False
+        self.lock = threading.Lock()
+
+    @property
+    def progress(self):
+        done = len(self.rows) - len(self.config.get("prefix_rows", []))
+        return min(done / max(self.config["years"], 1), 1.0)
+
+    def view(self):
+        with self.lock:
+            return list(self.rows), self.status
+
+    def run(self, backends):
+        cfg = self.config
+        self.status = "running"
+        try:
+            from espark_model import StrategicModel
+            llm = self.llm = LLMRouter(cfg["routing"], backends, self.owner, self.priority)
+            if cfg.get("snapshot"):
+                model = StrategicModel.from_snapshot(cfg["api_key"], cfg["prompt"], cfg["temperature"], cfg["snapshot"], llm)
+            else:
+                model = StrategicModel(cfg["api_key"], cfg["prompt"], cfg["temperature"], 1990, cfg["memory_tokens"], llm)
+            for _ in range(cfg["years"]):
+                if self.cancel_requested:
+                    self.status = "cancelled"
+                    return
+                snap = model.snapshot()
+                row = model.step()
+                with self.lock:
+                    self.checkpoints.append(snap)
+                    self.rows.append(row)
+            self.final_state = model.snapshot()
+            # 正常结束时由 JobManager 在移出 inflight 后发布 done
+        except Exception as e:
+            self.error = str(e)
+            self.status = "error"
+
+def config_key(config):
+    # 完整运行配置的指纹 (API Key 本身不参与，仅区分实际可调用哪些 LLM 后端)
+    payload = {k: v for k, v in config.items() if k != "api_key"}
+    payload["llm"] = reachable_backends(config["routing"], config.get("api_key"))
+    blob = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+class ResultStore:
+    """进程级结果存储：内存中仅保留最近使用的结果 (LRU)；设置 ESPARK_RESULT_DIR 时落盘，作为持久层跨进程复用。"""
+    def __init__(self, directory=None, max_entries=32):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.results = OrderedDict()
+        self.lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    @staticmethod
+    def _plain(value):
+        # 前缀行来自 DataFrame，可能含 numpy 标量
+        return value.item() if hasattr(value, "item") else str(value)
+
+    def _remember(self, key, result):
+        # 调用方持有锁
+        self.results[key] = result
+        self.results.move_to_end(key)
+        while len(self.results) > self.max_entries:
+            self.results.popitem(last=False)
+
+    def get(self, key):
+        with self.lock:
+            if key in self.results:
+                self.results.move_to_end(key)
+                return self.results[key]
+        if self.directory and os.path.exists(self._path(key)):
+            with open(self._path(key), "r", encoding="utf-8") as f:
+                result = json.load(f)
+            with self.lock:
+                self._remember(key, result)
+            return result
+        return None
+
+    def put(self, key, rows, checkpoints, final_state=None):
+        result = {"rows": rows, "checkpoints": checkpoints, "final_state": final_state}
+        with self.lock:
+            self._remember(key, result)
+        if self.directory:
+            tmp = self._path(key) + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(result, f, ensure_ascii=False, default=self._plain)
+            os.replace(tmp, self._path(key))
+
+class JobManager:
+    def __init__(self, max_workers=4, result_dir=None, result_cache_size=32, job_ttl=3600.0):
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="espark-sim")
+        self.store = ResultStore(result_dir, result_cache_size)
+        self.job_ttl = job_ttl  # 已结束但无人领取 (会话已关闭) 的任务保留时长 (秒)
+        self.backends = create_llm_backends()  # 后端健康状态在所有会话间共享
+        self.jobs = {}
+        self.inflight = {}  # 配置指纹 -> 进行中的任务
+        self.lock = threading.Lock()
+
+    def _sweep(self):
+        # 调用方持有锁：清理超时未被领取的已结束任务
+        now = time.monotonic()
+        for job_id in [j.id for j in self.jobs.values() if j.finished_at is not None and now - j.finished_at > self.job_ttl]:
+            del self.jobs[job_id]
+
+    def submit(self, config, owner=None, priority=INTERACTIVE):
+        key = config_key(config)
+        with self.lock:
+            self._sweep()
+            # 相同配置正在计算：合并为同一任务，结果共享给所有订阅者
+            job = self.inflight.get(key)
+            if job is not None and job.status in ("queued", "running"):
+                job.subscribers += 1
+                job.priority = min(job.priority, priority)  # 有交互式订阅者时提升优先级
+                if job.llm is not None:
+                    job.llm.priority = job.priority
+                return job
+            job = SimulationJob(config, key, owner, priority)
+            self.jobs[job.id] = job
+            cached = self.store.get(key)
+            if cached is not None:
+                job.rows, job.checkpoints = list(cached["rows"]), list(cached["checkpoints"])
+                job.final_state = cached.get("final_state")
+                job.status, job.cached = "done", True
+                job.finished_at = time.monotonic()
+                return job
+            self.inflight[key] = job
+        self.pool.submit(self._run, job)
+        return job
+
+    def _run(self, job):
+        job.run(self.backends)
+        completed = job.status == "running"
+        # 含失败步骤 (密钥错误、提供方故障等) 的结果不进入共享存储，避免被其他会话复用；
+        # 独立样本的指纹不会再次出现，同样无需存储
+        if completed and not job.config.get("replicate") and not any(row.get("Error") for row in job.rows):
+            self.store.put(job.key, list(job.rows), list(job.checkpoints), job.final_state)
+        with self.lock:
+            # 先移出 inflight 再发布 done：所属会话随后释放任务时，相同提交已改为命中存储而非加入该任务
+            self.inflight.pop(job.key, None)
+            job.finished_at = time.monotonic()
+            if completed:
+                job.status = "done"
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def cancel(self, job_id):
+        # 仅当没有其他会话订阅时才真正停止计算
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is not None and job.subscribers <= 1:
+                job.cancel_requested = True
+
+    def release(self, job_id):
+        with self.lock:
+            self._sweep()
+            job = self.jobs.get(job_id)
+            if job is None:
+                return
+            job.subscribers -= 1
+            if job.subscribers <= 0:
+                self.jobs.pop(job_id, None)
+
+@st.cache_resource
+def get_job_manager():
+    return JobManager(result_dir=os.environ.get("ESPARK_RESULT_DIR"),
+                      result_cache_size=int(os.environ.get("ESPARK_RESULT_CACHE", 32)))
+
+def collect_finished_jobs():
+    # 将本会话已结束的后台任务归档到历史 (任何页面都会执行)
+    manager = get_job_manager()
+    if 'analytics' not in st.session_state:
+        st.session_state.analytics = RunAnalytics()
+    still_active = []
+    for entry in st.session_state.active_jobs:
+        job = manager.get(entry['id'])
+        if job is None:
+            st.toast(f"推演结果已过期：{entry['label']}")
+            continue
+        if job.status in ("queued", "running"):
+            still_active.append(entry)
+            continue
+        cfg = job.config
+        if job.status == "done":
+            import pandas as pd
+            st.session_state.simulation_history.insert(0, {
+                'id': len(st.session_state.simulation_history) + 1,
+                'time': datetime.datetime.now().strftime("%H:%M:%S"),
+                'style': entry['label'],
+                'prompt': cfg['prompt'],
+                'temperature': cfg['temperature'],
+                'parent': entry['parent'],
+                'checkpoints': job.checkpoints,
+                'final_state': job.final_state,
+                'df': pd.DataFrame(job.rows)
+            })
+            st.session_state.analytics.add(st.session_state.simulation_history[0])
+            st.toast(f"{'♻️ 命中共享结果' if job.cached else '推演完成'}，已归档：{entry['label']}")
+        elif job.status == "error":
+            st.toast(f"推演失败：{job.error}")
+        manager.release(job.id)
+    st.session_state.active_jobs = still_active
+
+# --- 数据导出：逐块序列化 (不拼接整张表)，附带运行元数据 (人设/Prompt 指纹/温度) ---
+EXPORT_FORMATS = {
+    "CSV": ("csv", "text/csv"),
+    "Parquet": ("parquet", "application/vnd.apache.parquet"),
+    "Arrow IPC": ("arrow", "application/vnd.apache.arrow.file"),
+    "JSONL.gz": ("jsonl.gz", "application/gzip"),
+}
+
+def run_metadata(run):
+    return {"RunID": run['id'], "Persona": run['style'], "Temperature": float(run.get('temperature') or 0.0),
+            "Prompt_Hash": hashlib.sha256((run.get('prompt') or "").encode("utf-8")).hexdigest()[:12]}
+
+def _run_frames(runs, chunk_rows):
+    # 逐运行、逐块产出带元数据列的 DataFrame，不拼接整张大表
+    for run in runs:
+        df = run['df']
+        for start in range(0, len(df), chunk_rows):
+            yield df.iloc[start:start + chunk_rows].assign(**run_metadata(run))
+
+def _drain(buf):
+    data = buf.getvalue()
+    buf.seek(0)
+    buf.truncate()
+    return data
+
+def iter_export_chunks(runs, fmt, chunk_rows=2000):
+    meta = json.dumps([dict(run_metadata(r), Parent=r.get('parent')) for r in runs], ensure_ascii=False)
+    if fmt == "CSV":
+        for i, frame in enumerate(_run_frames(runs, chunk_rows)):
+            yield frame.to_csv(index=False, header=(i == 0)).encode('utf-8-sig' if i == 0 else 'utf-8')
+    elif fmt == "JSONL.gz":
+        buf = io.BytesIO()
+        with gzip.GzipFile(fileobj=buf, mode="wb") as gz:
+            gz.write((json.dumps({"_meta": json.loads(meta)}, ensure_ascii=False) + "\n").encode("utf-8"))
+            for frame in _run_frames(runs, chunk_rows):
+                gz.write(frame.to_json(orient="records", lines=True, force_ascii=False).encode("utf-8"))
+                yield _drain(buf)
+        yield _drain(buf)
+    else:
+        import pyarrow as pa  # streamlit 自带依赖
+        import pyarrow.ipc
+        import pyarrow.parquet as pq
+        schema = pa.schema([
+            ("Year", pa.int64()), ("Policy", pa.string()), ("Policy_Code", pa.int64()),
+            ("Economy", pa.string()), ("Labor_Lag", pa.string()), ("Thought", pa.string()), ("Error", pa.string()),
+            ("RunID", pa.int64()), ("Persona", pa.string()), ("Temperature", pa.float64()), ("Prompt_Hash", pa.string()),
+        ], metadata={"espark.runs": meta})
+        buf = io.BytesIO()
+        if fmt == "Parquet":
+            writer = pq.ParquetWriter(buf, schema, compression="zstd")
         else:
-            if year >= 2013 and self.policy_stage == 0: new_stage = 1; thought = "[模拟] 劳动力拐点显现，启动试点。"
-            elif year >= 2016 and self.policy_stage == 1: new_stage = 2; thought = "[模拟] 全面二孩时刻。"
-            elif year >= 2021 and self.policy_stage == 2: new_stage = 3; thought = "[模拟] 三孩时代。"
+            writer = pa.ipc.new_file(buf, schema, options=pa.ipc.IpcWriteOptions(compression="zstd"))
+        for frame in _run_frames(runs, chunk_rows):
+            writer.write_table(pa.Table.from_pandas(frame, schema=schema, preserve_index=False))
+            yield _drain(buf)
+        writer.close()
+        yield _drain(buf)
+
+def export_button(label, runs, fmt, file_stem, key):
+    # data 传入可调用对象：点击下载时才生成 (Streamlit 会一次性读入完整字节串，分块仅作用于生成过程)
+    ext, mime = EXPORT_FORMATS[fmt]
+    st.download_button(label, lambda: b"".join(iter_export_chunks(runs, fmt)),
+                       f"{file_stem}.{ext}", mime, key=key, on_click="ignore")
+
+# --- 跨运行对比分析：归档时增量计算特征与两两轨迹距离 ---
+HISTORICAL_SWITCHES = {1: 2013, 2: 2016, 3: 2021}  # 单独二孩 / 全面二孩 / 三孩 的历史年份
 
-        if new_stage > self.policy_stage: self.policy_stage = new_stage
+class RunAnalytics:
+    """Policy_Code 轨迹按年份对齐到 NaN 填充矩阵，距离与聚类均为向量化运算。"""
+    def __init__(self, base_year=1990):
+        self.base_year = base_year
+        self.ids = []
+        self.features = []
+        self.matrix = np.empty((0, 0), dtype=np.float32)  # 运行 × 年份
+        self.dist = np.empty((0, 0), dtype=np.float32)    # 两两距离：共同年份上的平均阶段差
+
+    @staticmethod
+    def summarize(run_id, years, codes):
+        feats = {"RunID": run_id}
+        for stage, hist_year in HISTORICAL_SWITCHES.items():
+            reached = np.flatnonzero(codes >= stage)
+            switch = float(years[reached[0]]) if reached.size else np.nan
+            feats[f"Switch_{stage}"] = switch
+            feats[f"Lag_{stage}"] = switch - hist_year
+        counts = np.bincount(codes, minlength=4)
+        for stage in range(4):
+            feats[f"Years_{stage}"] = int(counts[stage])
+        return feats
+
+    def add(self, run):
+        years = run['df']['Year'].to_numpy(dtype=np.int64)
+        codes = run['df']['Policy_Code'].to_numpy(dtype=np.int64)
+        self.ids.append(run['id'])
+        self.features.append(self.summarize(run['id'], years, codes))
+        
+        # 扩展矩阵列宽 (新年份以 NaN 填充)，再写入新行
+        cols = max(self.matrix.shape[1], int(years.max()) - self.base_year + 1)
+        if cols > self.matrix.shape[1]:
+            self.matrix = np.pad(self.matrix, ((0, 0), (0, cols - self.matrix.shape[1])), constant_values=np.nan)
+        row = np.full(cols, np.nan, dtype=np.float32)
+        row[years - self.base_year] = codes
+        self.matrix = np.vstack([self.matrix, row])
         
-        return {"Year": year, "Policy": self.policy_names[self.policy_stage], "Policy_Code": self.policy_stage, 
-                "Economy": economy_context, "Labor_Lag": labor_status, "Thought": thought}
-
-class StrategicModel(mesa.Model):
-    def __init__(self, api_key, system_prompt, temperature, start_year):
-        super().__init__()
-        self.api_key = api_key
-        self.system_prompt = system_prompt
-        self.temperature = temperature
-        self.year = start_year
-        self.agent = StrategicAgent("Gov", self)
-
-    def get_economic_context(self, year):
-        if year < 2000: return "经济起飞期"
-        elif year < 2010: return "WTO黄金期"
-        elif year < 2015: return "新常态转折点"
-        else: return "高质量发展期"
-
-    def get_labor_supply_status(self, year):
-        birth_year = year - 20
-        if birth_year < 1975: return "充沛"
-        elif birth_year < 1990: return "充足"
-        else: return "严重短缺"
-
-    def get_grassroots_feedback(self, year):
-        return "执行难度大" if year < 2000 else "群众意愿低迷"
-
-    def step(self):
-        res = self.agent.step()
-        self.year += 1
-        return res
+        # 仅计算新运行与已有运行的距离：O(N·T)
+        diff = np.abs(self.matrix - row)
+        valid = ~np.isnan(diff)
+        d = np.where(valid.any(axis=1), np.nansum(diff, axis=1) / np.maximum(valid.sum(axis=1), 1), np.nan).astype(np.float32)
+        self.dist = np.pad(self.dist, ((0, 1), (0, 1)))
+        self.dist[-1, :] = d
+        self.dist[:, -1] = d
+
+    def feature_frame(self):
+        import pandas as pd
+        return pd.DataFrame(self.features)
+
+    def cluster(self, k, iters=20):
+        # 基于距离矩阵的 k-medoids；初始中心取最远点优先，结果确定
+        n = len(self.ids)
+        k = max(1, min(k, n))
+        dist = np.nan_to_num(self.dist, nan=np.nanmax(self.dist) if n > 1 else 0.0)
+        medoids = [int(dist.sum(axis=1).argmin())]
+        while len(medoids) < k:
+            gap = dist[:, medoids].min(axis=1)
+            gap[medoids] = -1  # 轨迹完全相同时也保证中心互不重复
+            medoids.append(int(gap.argmax()))
+        medoids = np.array(medoids)
+        for _ in range(iters):
+            labels = dist[:, medoids].argmin(axis=1)
+            new = medoids.copy()
+            for c in range(k):
+                members = np.flatnonzero(labels == c)
+                if members.size == 0:
+                    continue
+                new[c] = members[dist[np.ix_(members, members)].sum(axis=1).argmin()]
+            if np.array_equal(new, medoids):
+                break
+            medoids = new
+        return dist[:, medoids].argmin(axis=1)
 
 def render_chart(df):
     fig = go.Figure()
@@ -210,6 +514,168 @@ def render_chart(df):
     )
     return fig
 
+def render_ensemble_chart(analytics, run_ids=None, max_lines=60, show_bands=True):
+    # 多轨迹叠加：阶段密度 + 分位数带 + 抽样轨迹 (Scattergl)，图表体积与运行数无关
+    rows = np.arange(len(analytics.ids)) if run_ids is None else np.flatnonzero(np.isin(analytics.ids, run_ids))
+    matrix = analytics.matrix[rows]
+    years = analytics.base_year + np.arange(matrix.shape[1])
+    fig = go.Figure()
+    if show_bands:
+        # 仅保留所选运行覆盖的年份，避免对全 NaN 列求分位数
+        covered = ~np.isnan(matrix).all(axis=0)
+        matrix, band_years = matrix[:, covered], years[covered]
+        observed = ~np.isnan(matrix)
+        density = np.stack([(matrix == stage).sum(axis=0) for stage in range(4)]) / np.maximum(observed.sum(axis=0), 1)
+        fig.add_trace(go.Heatmap(x=band_years, y=[0, 1, 2, 3], z=density, colorscale=[[0, 'rgba(77,107,254,0)'], [1, 'rgba(77,107,254,0.55)']],
+                                 showscale=False, hovertemplate="%{x} · 阶段 %{y}: %{z:.0%}<extra></extra>"))
+        q10, q50, q90 = np.nanpercentile(matrix, [10, 50, 90], axis=0)
+        fig.add_trace(go.Scattergl(x=band_years, y=q10, mode='lines', line=dict(width=0, shape='hv'), showlegend=False, hoverinfo='skip'))
+        fig.add_trace(go.Scattergl(x=band_years, y=q90, mode='lines', name='P10–P90', fill='tonexty', fillcolor='rgba(255,183,77,0.15)', line=dict(width=0, shape='hv')))
+        fig.add_trace(go.Scattergl(x=band_years, y=q50, mode='lines', name='中位数', line=dict(color='#ffb74d', width=3, shape='hv')))
+    
+    # 服务端降采样：最多绘制 max_lines 条，且每条阶梯轨迹只保留转折点 (无损)
+    picks = rows if len(rows) <= max_lines else rows[np.linspace(0, len(rows) - 1, max_lines).astype(int)]
+    xs, ys = [], []
+    for r in picks:
+        traj = analytics.matrix[r]
+        idx = np.flatnonzero(~np.isnan(traj))
+        change = np.r_[True, np.diff(traj[idx]) != 0]
+        change[-1] = True  # 保留终点
+        keep = idx[change]
+        xs += years[keep].tolist() + [None]
+        ys += traj[keep].tolist() + [None]
+    fig.add_trace(go.Scattergl(x=xs, y=ys, mode='lines', name=f'轨迹 ×{len(picks)}/{len(rows)}',
+                               line=dict(color='rgba(224,230,237,0.25)', width=1, shape='hv'), hoverinfo='skip'))
+    fig.update_layout(
+        template="plotly_dark",
+        paper_bgcolor='rgba(0,0,0,0)', plot_bgcolor='rgba(0,0,0,0)',
+        height=420, margin=dict(l=10,r=10,t=10,b=10), legend=dict(orientation="h", y=1.05),
+        xaxis=dict(showgrid=False),
+        yaxis=dict(showgrid=True, gridcolor='#333', range=[-0.5, 3.5], tickvals=[0,1,2,3], ticktext=["一孩","试点","二孩","三孩"])
+    )
+    return fig
+
+@st.cache_resource
+def sidebar_figure():
+    # 装饰图表只构建一次，避免每次重跑都重新生成
+    x = np.linspace(0, 10, 100)
+    y = np.sin(x) * np.random.rand(100)
+    fig_net = go.Figure(go.Scatter(x=x, y=y, line=dict(color='#4d6bfe', width=1), fill='tozeroy', fillcolor='rgba(77, 107, 254, 0.1)'))
+    fig_net.update_layout(height=80, margin=dict(l=0,r=0,t=0,b=0), paper_bgcolor='rgba(0,0,0,0)', plot_bgcolor='rgba(0,0,0,0)', xaxis=dict(visible=False), yaxis=dict(visible=False))
+    return fig_net
+
+@st.cache_resource
+def market_position_figure():
+    # 静态图表：每个进程只构建一次
+    fig = go.Figure()
+
+    # 各产品在二维空间的位置
+    products = {
+        "NetLogo": (2, 8, "传统ABM"),
+        "AnyLogic": (3, 7, "商业仿真"),
+        "PolicyEngine": (5, 6, "微观模拟"),
+        "ChatGPT": (8, 4, "通用AI"),
+        "Claude": (7, 5, "企业AI"),
+        "Smallville": (9, 9, "生成式智能体"),
+        "Autogen": (8, 7, "多智能体"),
+        "Espark": (7, 9, "政策G-ABM")
+    }
+
+    for product, (x, y, category) in products.items():
+        color = "#4d6bfe" if product == "Espark" else "#666"
+        size = 20 if product == "Espark" else 12
+
+        fig.add_trace(go.Scatter(
+            x=[x], y=[y],
+            mode='markers+text',
+            marker=dict(size=size, color=color),
+            text=[product],
+            textposition="top center",
+            name=category,
+            hoverinfo='text',
+            hovertext=f"{product}: {category}"
+        ))
+
+    fig.update_layout(
+        title="市场定位：传统性 vs AI驱动性",
+        xaxis_title="AI驱动性 (低 → 高)",
+        yaxis_title="政策专业性 (低 → 高)",
+        template="plotly_dark",
+        height=500,
+        paper_bgcolor='rgba(0,0,0,0)',
+        plot_bgcolor='rgba(0,0,0,0)',
+        xaxis=dict(range=[0, 10], showgrid=True, gridcolor='#333'),
+        yaxis=dict(range=[0, 10], showgrid=True, gridcolor='#333'),
+        showlegend=False
+    )
+
+    # 添加象限说明
+    fig.add_annotation(x=2.5, y=2.5, text="传统工具区", showarrow=False, font=dict(color="#888", size=12))
+    fig.add_annotation(x=7.5, y=2.5, text="通用AI区", showarrow=False, font=dict(color="#888", size=12))
+    fig.add_annotation(x=2.5, y=7.5, text="专业仿真区", showarrow=False, font=dict(color="#888", size=12))
+    fig.add_annotation(x=7.5, y=7.5, text="前沿创新区", showarrow=False, font=dict(color="#4d6bfe", size=14, weight="bold"))
+    return fig
+
+@st.fragment(run_every=1.0)
+def render_live_jobs():
+    manager = get_job_manager()
+    entries = [(entry, manager.get(entry['id'])) for entry in st.session_state.active_jobs]
+    entries = [(entry, job) for entry, job in entries if job is not None]
+    if any(job.status not in ("queued", "running") for _, job in entries):
+        st.rerun()  # 有任务结束：整页重跑以归档
+    
+    for entry, job in reversed(entries):
+        rows, status = job.view()
+        title_col, cancel_col = st.columns([8, 2])
+        shared = f" · 👥 {job.subscribers} 个会话共享" if job.subscribers > 1 else ""
+        title_col.markdown(f"**{entry['label']}** · `{job.id}` · {'排队中' if status == 'queued' else '运行中'}{shared}")
+        if cancel_col.button("⏹ 取消", key=f"cancel_{job.id}"):
+            manager.cancel(job.id)
+            if job.subscribers > 1:
+                # 其他会话仍在等待该结果：仅退订本会话
+                manager.release(job.id)
+                st.session_state.active_jobs.remove(entry)
+                st.rerun()
+        st.progress(job.progress)
+        if not rows:
+            continue
+        
+        live_dash, live_log = st.columns([6, 4])
+        with live_dash:
+            # 实时图表
+            st.plotly_chart(render_chart({'Year': [r['Year'] for r in rows], 'Policy_Code': [r['Policy_Code'] for r in rows]}),
+                            use_container_width=True, key=f"live_{job.id}")
+        
+        # 实时日志 (最新置顶 + 历史收纳)
+        with live_log:
+            # 1. 高亮显示最新日志
+            latest = rows[-1]
+            pol_color = "#4d6bfe" if latest['Policy_Code'] > 0 else "#666"
+            st.markdown(f"""
+            <div class="latest-card">
+                <div style="display:flex; justify-content:space-between; align-items:center; margin-bottom:10px;">
+                    <span style="font-weight:bold; color:white; font-size:1.1em;">🔥 Year {latest['Year']} 决策中枢</span>
+                    <span style="background:{pol_color}; padding:2px 8px; border-radius:4px; font-size:12px;">{latest['Policy']}</span>
+                </div>
+                <div style="color:#ddd; font-family:'Courier New'; font-size:0.9em;">{latest['Thought']}</div>
+            </div>
+            """, unsafe_allow_html=True)
+            
+            # 2. 历史日志折叠收纳
+            if len(rows) > 1:
+                with st.expander(f"📚 查看过往 {len(rows)-1} 条记录", expanded=False):
+                    # 倒序遍历
+                    for log in reversed(rows[:-1]):
+                        st.markdown(f"""
+                        <div style="border-bottom:1px solid #333; padding:8px 0;">
+                            <span style="color:#4d6bfe; font-weight:bold;">{log['Year']}</span> 
+                            <span style="color:#888;">{log['Policy']}</span><br>
+                            <span style="color:#888; font-size:0.85em;">{log['Thought'][:50]}...</span>
+                        </div>
+                        """, unsafe_allow_html=True)
+
+collect_finished_jobs()
+
 # ==============================================================================
 # 3. 侧边栏布局 (保持 320px 铺满设计 - 严格不动)
 # ==============================================================================
@@ -223,11 +689,7 @@ with st.sidebar:
     """, unsafe_allow_html=True)
     
     # 装饰图表 (铺满)
-    x = np.linspace(0, 10, 100)
-    y = np.sin(x) * np.random.rand(100)
-    fig_net = go.Figure(go.Scatter(x=x, y=y, line=dict(color='#4d6bfe', width=1), fill='tozeroy', fillcolor='rgba(77, 107, 254, 0.1)'))
-    fig_net.update_layout(height=80, margin=dict(l=0,r=0,t=0,b=0), paper_bgcolor='rgba(0,0,0,0)', plot_bgcolor='rgba(0,0,0,0)', xaxis=dict(visible=False), yaxis=dict(visible=False))
-    st.plotly_chart(fig_net, use_container_width=True, config={'displayModeBar': False})
+    st.plotly_chart(sidebar_figure(), use_container_width=True, config={'displayModeBar': False})
     
     # 导航菜单
     menu = st.radio(
@@ -239,6 +701,15 @@ with st.sidebar:
     st.markdown("---")
     st.markdown("### 🔑 Global Config")
     api_key_input = st.text_input("DeepSeek API Key", type="password")
+    llm_routing = st.selectbox("模型路由", list(LLM_ROUTING))
+    with st.expander("🔌 LLM 后端状态", expanded=False):
+        for backend in get_job_manager().backends.values():
+            state = "⚪ 未配置" if not backend.key_for(api_key_input) else ("🟢" if backend.available() else "🔴 熔断中")
+            latency = f"{backend.latency:.1f}s" if backend.latency is not None else "—"
+            queued = len(backend.limiter.waiting)
+            st.caption(f"{state} {backend.name} · `{backend.model}` · 调用 {backend.calls} · 延迟 {latency}" + (f" · 排队 {queued}" if queued else ""))
+    if st.session_state.active_jobs:
+        st.caption(f"⏳ 后台推演中：{len(st.session_state.active_jobs)} 个任务")
 
 # ==============================================================================
 # 4. 主界面内容
@@ -253,88 +724,50 @@ if menu == "🛠️ 智能沙盘 (Playground)":
     with st.expander("🎛️ 新建推演配置 (New Simulation)", expanded=True):
         c1, c2 = st.columns([2, 1])
         with c1:
-            gov_style = st.selectbox("决策者人设", ["稳健型 (历史真实)", "激进改革型", "僵化保守型"])
-            if gov_style.startswith("稳健"):
-                default_prompt = "你是一个对历史负责的战略家。深知'人口政策有20年滞后性'。坚持民主集中制，不被短期民意裹挟。"
-                temp = 0.3
-            elif gov_style.startswith("激进"):
-                default_prompt = "你是一个极具前瞻性的改革家。高度关注'20年后的劳动力危机'，一旦发现异常，宁可牺牲当下经济也要提前改革。"
-                temp = 0.7
-            else:
-                default_prompt = "你是一个短视的决策者。只关注当下的GDP增长，完全忽略20年后的劳动力隐患。"
-                temp = 0.1
+            gov_style = st.selectbox("决策者人设", list(PERSONAS))
+            default_prompt, temp = PERSONAS[gov_style]
             sys_prompt = st.text_area("System Prompt", value=default_prompt, height=70)
         with c2:
             temperature = st.slider("思维活跃度", 0.0, 1.0, temp)
-            sim_years = st.number_input("推演年数", 20, 50, 35)
+            sim_years = st.number_input("推演年数", 20, 100, 35)
+            memory_tokens = st.number_input("记忆上限 (tokens)", 100, 2000, 400, step=100)
+            batch_mode = st.checkbox("批量任务 (低优先级)", help="限流时让位于交互式推演")
+            reuse_results = st.checkbox("♻️ 复用共享结果", value=True, help="取消勾选则重新采样 LLM，用于同配置多次推演的集成分析")
             st.markdown("<br>", unsafe_allow_html=True)
             run_btn = st.button("🚀 启动新推演")
 
-    # --- B. 运行区 ---
-    if run_btn:
+    # --- B. 运行区 (提交到后台任务队列) ---
+    fork_req = st.session_state.pop('fork_request', None)
+    if run_btn or fork_req:
+        if fork_req:
+            # 分叉/续跑：复用父推演的前缀与检查点，只重算分叉点之后的年份
+            parent, idx = fork_req['parent'], fork_req['index']
+            snapshot = parent['checkpoints'][idx] if idx < len(parent['checkpoints']) else parent['final_state']
+            config = {
+                'api_key': api_key_input, 'prompt': fork_req['prompt'], 'temperature': fork_req['temperature'], 'routing': llm_routing,
+                'years': fork_req['end_year'] - fork_req['year'] + 1,
+                'snapshot': snapshot,
+                'prefix_rows': parent['df'].iloc[:idx].to_dict('records'),
+                'prefix_checkpoints': parent['checkpoints'][:idx],
+            }
+            entry = {'label': f"{fork_req['style']} ⑂ Run #{parent['id']}@{fork_req['year']}", 'parent': parent['id']}
+        else:
+            config = {
+                'api_key': api_key_input, 'prompt': sys_prompt, 'temperature': temperature, 'routing': llm_routing,
+                'years': sim_years, 'memory_tokens': memory_tokens,
+            }
+            entry = {'label': gov_style, 'parent': None}
+        if not reuse_results:
+            config['replicate'] = uuid.uuid4().hex  # 独立样本：指纹唯一，不命中缓存
+        # 相同配置在任意会话中已有结果或正在计算时，直接复用/合并
+        job = get_job_manager().submit(config, st.session_state.session_id, BATCH if batch_mode else INTERACTIVE)
+        st.session_state.active_jobs.append(dict(entry, id=job.id))
+
+    if st.session_state.active_jobs:
         st.divider()
         st.subheader("🔥 正在推演 (Live Simulation)")
-        
-        live_dash, live_log = st.columns([6, 4])
-        with live_dash:
-            chart_placeholder = st.empty()
-        with live_log:
-            log_placeholder = st.empty()
-        
-        current_run_data = []
-        model = StrategicModel(api_key_input, sys_prompt, temperature, 1990)
-        progress = st.progress(0)
-        
-        for i in range(sim_years):
-            step_data = model.step()
-            current_run_data.append(step_data)
-            df_live = pd.DataFrame(current_run_data)
-            
-            # 实时图表
-            chart_placeholder.plotly_chart(render_chart(df_live), use_container_width=True)
-            
-            # 实时日志 (最新置顶 + 历史收纳)
-            with log_placeholder.container():
-                # 1. 高亮显示最新日志
-                latest = step_data
-                pol_color = "#4d6bfe" if latest['Policy_Code'] > 0 else "#666"
-                st.markdown(f"""
-                <div class="latest-card">
-                    <div style="display:flex; justify-content:space-between; align-items:center; margin-bottom:10px;">
-                        <span style="font-weight:bold; color:white; font-size:1.1em;">🔥 Year {latest['Year']} 决策中枢</span>
-                        <span style="background:{pol_color}; padding:2px 8px; border-radius:4px; font-size:12px;">{latest['Policy']}</span>
-                    </div>
-                    <div style="color:#ddd; font-family:'Courier New'; font-size:0.9em;">{latest['Thought']}</div>
-                </div>
-                """, unsafe_allow_html=True)
-                
-                # 2. 历史日志折叠收纳
-                if len(current_run_data) > 1:
-                    with st.expander(f"📚 查看过往 {len(current_run_data)-1} 条记录", expanded=False):
-                        # 倒序遍历
-                        for log in reversed(current_run_data[:-1]):
-                            st.markdown(f"""
-                            <div style="border-bottom:1px solid #333; padding:8px 0;">
-                                <span style="color:#4d6bfe; font-weight:bold;">{log['Year']}</span> 
-                                <span style="color:#888;">{log['Policy']}</span><br>
-                                <span style="color:#888; font-size:0.85em;">{log['Thought'][:50]}...</span>
-                            </div>
-                            """, unsafe_allow_html=True)
-
-            time.sleep(0.05)
-            progress.progress((i+1)/sim_years)
-        
-        # 归档
-        run_id = len(st.session_state.simulation_history) + 1
-        st.session_state.simulation_history.insert(0, {
-            'id': run_id,
-            'time': datetime.datetime.now().strftime("%H:%M:%S"),
-            'style': gov_style,
-            'df': pd.DataFrame(current_run_data)
-        })
-        st.success("推演完成，结果已归档。")
-        time.sleep(1)
-        st.rerun()
+        st.caption("推演在后台运行：可同时启动多个推演，切换页面后返回即可继续查看。")
+        render_live_jobs()
 
     # --- C. 历史档案区 (交互核心：点击了解) ---
     if st.session_state.simulation_history:
@@ -353,8 +786,31 @@ if menu == "🛠️ 智能沙盘 (Playground)":
                     st.markdown("#### 📉 战略态势回放")
                     st.plotly_chart(render_chart(run['df']), use_container_width=True, key=f"c_{run['id']}")
                     
-                    csv = run['df'].to_csv(index=False).encode('utf-8-sig')
-                    st.download_button(f"📥 导出 Run #{run['id']} 数据", csv, f"sim_{run['id']}.csv", "text/csv")
+                    fmt_col, dl_col = st.columns([1, 2])
+                    fmt = fmt_col.selectbox("格式", list(EXPORT_FORMATS), key=f"fmt_{run['id']}", label_visibility="collapsed")
+                    with dl_col:
+                        export_button(f"📥 导出 Run #{run['id']} 数据", [run], fmt, f"sim_{run['id']}", key=f"dl_{run['id']}")
+                    
+                    # 分叉：从任意年份的检查点出发，换人设/参数重新推演
+                    if run.get('checkpoints'):
+                        with st.popover("🔀 从此推演分叉 (Fork)"):
+                            years = run['df']['Year'].tolist()
+                            if run.get('final_state'):
+                                years.append(years[-1] + 1)  # 末年之后：在原终点基础上续跑
+                            fork_year = st.selectbox("分叉年份", years, key=f"fy_{run['id']}",
+                                                     format_func=lambda y, last=years[-1]: f"{y} (续跑)" if y == last and run.get('final_state') else str(y))
+                            parent_end = int(run['df']['Year'].iloc[-1])
+                            end_year = st.number_input("推演至 (年份)", fork_year, fork_year + 99, parent_end if fork_year <= parent_end else fork_year + 9,
+                                                       key=f"fe_{run['id']}_{fork_year}")
+                            fork_style = st.selectbox("决策者人设", list(PERSONAS), key=f"fs_{run['id']}")
+                            fork_prompt = st.text_area("System Prompt", value=PERSONAS[fork_style][0], height=70, key=f"fp_{run['id']}_{fork_style}")
+                            fork_temp = st.slider("思维活跃度", 0.0, 1.0, PERSONAS[fork_style][1], key=f"ft_{run['id']}_{fork_style}")
+                            if st.button("🚀 从该年重新推演", key=f"fb_{run['id']}"):
+                                st.session_state.fork_request = {
+                                    'parent': run, 'index': years.index(fork_year), 'year': fork_year,
+                                    'style': fork_style, 'prompt': fork_prompt, 'temperature': fork_temp, 'end_year': int(end_year)
+                                }
+                                st.rerun()
                 
                 # 右侧：决策思维链条 (带滚动条)
                 with h_col2:
@@ -378,9 +834,47 @@ if menu == "🛠️ 智能沙盘 (Playground)":
 elif menu == "📜 输出记录 (Logs)":
     st.markdown("# 📜 全局数据中心")
     if st.session_state.simulation_history:
+        import pandas as pd
         all_dfs = [run['df'].assign(RunID=run['id']) for run in st.session_state.simulation_history]
         full_df = pd.concat(all_dfs)
         st.dataframe(full_df, use_container_width=True)
+        
+        # 批量导出：选中的运行或整张日志表
+        run_ids = [run['id'] for run in st.session_state.simulation_history]
+        e1, e2, e3 = st.columns([3, 1, 1])
+        selected = e1.multiselect("导出运行 (留空 = 全部)", run_ids, format_func=lambda i: f"Run #{i}")
+        fmt = e2.selectbox("格式", list(EXPORT_FORMATS), key="fmt_logs")
+        runs = [run for run in st.session_state.simulation_history if not selected or run['id'] in selected]
+        with e3:
+            st.markdown("<br>", unsafe_allow_html=True)
+            export_button(f"📥 导出 {len(runs)} 个运行", runs, fmt, "espark_logs", key="dl_logs")
+        
+        # 跨运行对比分析
+        st.markdown("---")
+        st.markdown("### 📊 跨运行对比分析")
+        st.caption("Switch_k：首次进入阶段 k 的年份；Lag_k：相对历史节点 (2013/2016/2021) 的提前(-)或滞后(+)年数；Years_k：处于阶段 k 的年数。")
+        analytics = st.session_state.analytics
+        feats = analytics.feature_frame()
+        if len(analytics.ids) >= 2:
+            k = st.slider("聚类数 (k-medoids)", 1, min(8, len(analytics.ids)), min(3, len(analytics.ids)))
+            feats = feats.assign(Cluster=analytics.cluster(k) + 1)
+        st.dataframe(feats, use_container_width=True, hide_index=True)
+        if len(analytics.ids) >= 2:
+            labels = [f"#{i}" for i in analytics.ids]
+            fig_dist = go.Figure(go.Heatmap(z=analytics.dist, x=labels, y=labels, colorscale="Blues", colorbar=dict(title="Δ阶段/年")))
+            fig_dist.update_layout(
+                title="轨迹两两距离 (共同年份上的平均政策阶段差)", template="plotly_dark", height=450,
+                paper_bgcolor='rgba(0,0,0,0)', plot_bgcolor='rgba(0,0,0,0)', margin=dict(l=10,r=10,t=40,b=10)
+            )
+            st.plotly_chart(fig_dist, use_container_width=True)
+            
+            # 多轨迹叠加 (Ensemble)
+            st.markdown("#### 🌊 轨迹叠加 (Ensemble)")
+            o1, o2, o3 = st.columns([3, 1, 1])
+            overlay_ids = o1.multiselect("叠加运行 (留空 = 全部)", analytics.ids, format_func=lambda i: f"Run #{i}", key="overlay_ids")
+            max_lines = o2.slider("最多绘制轨迹", 10, 200, 60, step=10)
+            show_bands = o3.checkbox("密度/分位数带", value=True)
+            st.plotly_chart(render_ensemble_chart(analytics, overlay_ids or None, max_lines, show_bands), use_container_width=True)
     else:
         st.info("暂无数据")
 
@@ -561,6 +1055,7 @@ elif menu == "⚙️ 核心逻辑 (Core)":
 
 # --- 场景 4：市场对标 (深度市场版) ---
 elif menu == "🌐 市场对标 (Market)":
+    import pandas as pd
     st.markdown("# 🌐 市场对标分析")
     
     # 引入
@@ -749,56 +1244,8 @@ elif menu == "🌐 市场对标 (Market)":
     st.markdown("---")
     st.markdown("### 🗺️ 市场定位图谱")
     
-    # 创建一个简单的市场定位图表
-    fig = go.Figure()
-    
-    # 各产品在二维空间的位置
-    products = {
-        "NetLogo": (2, 8, "传统ABM"),
-        "AnyLogic": (3, 7, "商业仿真"),
-        "PolicyEngine": (5, 6, "微观模拟"),
-        "ChatGPT": (8, 4, "通用AI"),
-        "Claude": (7, 5, "企业AI"),
-        "Smallville": (9, 9, "生成式智能体"),
-        "Autogen": (8, 7, "多智能体"),
-        "Espark": (7, 9, "政策G-ABM")
-    }
-    
-    for product, (x, y, category) in products.items():
-        color = "#4d6bfe" if product == "Espark" else "#666"
-        size = 20 if product == "Espark" else 12
-        
-        fig.add_trace(go.Scatter(
-            x=[x], y=[y],
-            mode='markers+text',
-            marker=dict(size=size, color=color),
-            text=[product],
-            textposition="top center",
-            name=category,
-            hoverinfo='text',
-            hovertext=f"{product}: {category}"
-        ))
-    
-    fig.update_layout(
-        title="市场定位：传统性 vs AI驱动性",
-        xaxis_title="AI驱动性 (低 → 高)",
-        yaxis_title="政策专业性 (低 → 高)",
-        template="plotly_dark",
-        height=500,
-        paper_bgcolor='rgba(0,0,0,0)',
-        plot_bgcolor='rgba(0,0,0,0)',
-        xaxis=dict(range=[0, 10], showgrid=True, gridcolor='#333'),
-        yaxis=dict(range=[0, 10], showgrid=True, gridcolor='#333'),
-        showlegend=False
-    )
-    
-    # 添加象限说明
-    fig.add_annotation(x=2.5, y=2.5, text="传统工具区", showarrow=False, font=dict(color="#888", size=12))
-    fig.add_annotation(x=7.5, y=2.5, text="通用AI区", showarrow=False, font=dict(color="#888", size=12))
-    fig.add_annotation(x=2.5, y=7.5, text="专业仿真区", showarrow=False, font=dict(color="#888", size=12))
-    fig.add_annotation(x=7.5, y=7.5, text="前沿创新区", showarrow=False, font=dict(color="#4d6bfe", size=14, weight="bold"))
-    
-    st.plotly_chart(fig, use_container_width=True)
+    # 创建一个简单的市场定位图表 (已缓存)
+    st.plotly_chart(market_position_figure(), use_container_width=True)
     
     # 总结
     st.markdown("---")
@@ -0,0 +1,242 @@
+# ==============================================================================
+# Espark LLM 后端：多提供方 + 路由 + 自动降级 (轻量模块，openai 按需导入)
+# ==============================================================================
+import os
+import math
+import time
+import threading
+import email.utils
+
+INTERACTIVE, BATCH = 0, 1  # 请求优先级：交互式推演优先于批量任务
+
+LLM_PROVIDERS = {
+    "DeepSeek Chat": {"base_url": "https://api.deepseek.com", "model": "deepseek-chat", "max_tokens": 300, "timeout": 20.0},
+    "DeepSeek Reasoner": {"base_url": "https://api.deepseek.com", "model": "deepseek-reasoner", "max_tokens": 2000, "timeout": 60.0},
+    "本地模型 (OpenAI 兼容)": {"base_url": os.environ.get("ESPARK_LOCAL_LLM_URL", "http://localhost:8000/v1"),
+                              "model": os.environ.get("ESPARK_LOCAL_LLM_MODEL", "local-model"), "max_tokens": 300, "timeout": 30.0,
+                              # 配置了地址或密钥才视为可用；本地服务从不使用用户的 DeepSeek Key
+                              "api_key": os.environ.get("ESPARK_LOCAL_LLM_KEY") or ("EMPTY" if os.environ.get("ESPARK_LOCAL_LLM_URL") else None),
+                              "user_key": False},
+}
+
+# 各提供方 (按 base_url) 的每分钟请求数 / token 数上限，同一账号下的模型共享额度
+RATE_LIMITS = {
+    "https://api.deepseek.com": (int(os.environ.get("ESPARK_DEEPSEEK_RPM", 60)), int(os.environ.get("ESPARK_DEEPSEEK_TPM", 120000))),
+}
+DEFAULT_RATE_LIMIT = (600, 1000000)
+
+SLOW_PROBE_INTERVAL = 120.0  # 过慢后端被降级的时长 (秒)，到期后重新探测
+
+# 路由预设：常规年份 / 关键年份各自的候选链 (按优先级，失败或过慢时依次降级)
+LLM_ROUTING = {
+    "自动路由 (常规→Chat，关键年→Reasoner)": {
+        "routine": ["DeepSeek Chat", "本地模型 (OpenAI 兼容)"],
+        "pivotal": ["DeepSeek Reasoner", "DeepSeek Chat", "本地模型 (OpenAI 兼容)"]},
+    "仅 DeepSeek Chat": {"routine": ["DeepSeek Chat"], "pivotal": ["DeepSeek Chat"]},
+    "本地优先 (DeepSeek 兜底)": {
+        "routine": ["本地模型 (OpenAI 兼容)", "DeepSeek Chat"],
+        "pivotal": ["DeepSeek Chat", "本地模型 (OpenAI 兼容)"]},
+}
+
+def estimate_tokens(text):
+    # 粗估：中日韩字符约 1 token/字，其余约 4 字符/token
+    cjk = sum(1 for ch in text if '\u3000' <= ch <= '\u9fff' or '\uff00' <= ch <= '\uffef')
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+def retry_after_seconds(error, attempt):
+    # 解析 429 响应的 Retry-After (秒数或 HTTP 日期)；缺省或格式异常时指数退避
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            seconds = float(headers["retry-after-ms"]) / 1000
+        elif headers.get("retry-after"):
+            value = headers["retry-after"]
+            try:
+                seconds = float(value)
+            except ValueError:
+                seconds = email.utils.parsedate_to_datetime(value).timestamp() - time.time()
+        else:
+            seconds = None
+        if seconds is not None and math.isfinite(seconds):
+            return max(seconds, 0.0)
+    except (TypeError, ValueError, OverflowError):
+        pass
+    return min(60.0, 2.0 ** attempt)
+
+class RateLimiter:
+    """进程级令牌桶：限制 RPM/TPM；交互优先，同级内按会话轮转，会话内先到先得。"""
+    def __init__(self, rpm, tpm):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.requests = float(rpm)
+        self.tokens = float(tpm)
+        self.stamp = time.monotonic()
+        self.paused_until = 0.0   # Retry-After 期间暂停放行
+        self.waiting = []         # 等待中的请求 [priority, seq, owner, tokens]
+        self.last_served = {}     # 会话 -> 上次放行序号
+        self.seq = 0
+        self.served = 0
+        self.cond = threading.Condition()
+
+    def _refill(self, now):
+        elapsed, self.stamp = now - self.stamp, now
+        self.requests = min(self.rpm, self.requests + self.rpm * elapsed / 60)
+        self.tokens = min(self.tpm, self.tokens + self.tpm * elapsed / 60)
+
+    def _head(self):
+        return min(self.waiting, key=lambda t: (t[0], self.last_served.get(t[2], 0), t[1]))
+
+    def acquire(self, tokens, priority=INTERACTIVE, owner=None):
+        with self.cond:
+            tokens = min(tokens, self.tpm)
+            ticket = [priority, self.seq, owner, tokens]
+            self.seq += 1
+            self.waiting.append(ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    if self._head() is ticket and now >= self.paused_until and self.requests >= 1 and self.tokens >= tokens:
+                        self.requests -= 1
+                        self.tokens -= tokens
+                        self.served += 1
+                        self.last_served[owner] = self.served
+                        return
+                    # 仅队首需要等待额度恢复，其余请求等待被唤醒
+                    wait = max(self.paused_until - now, (1 - self.requests) * 60 / self.rpm, (tokens - self.tokens) * 60 / self.tpm, 0.05)
+                    self.cond.wait(timeout=wait)
+            finally:
+                self.waiting.remove(ticket)
+                self.cond.notify_all()
+
+    def refund(self, tokens):
+        # 实际用量低于预估时归还多扣的 token
+        with self.cond:
+            self.tokens = min(self.tpm, self.tokens + max(tokens, 0))
+            self.cond.notify_all()
+
+    def pause(self, seconds):
+        with self.cond:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.cond.notify_all()
+
+class RateLimited(Exception):
+    pass
+
+class LLMBackend:
+    """单个模型端点：复用客户端，记录延迟与健康状态 (进程内共享)。"""
+    def __init__(self, name, base_url, model, max_tokens, timeout, api_key=None, user_key=True, slow_factor=0.5, limiter=None):
+        self.name = name
+        self.limiter = limiter or RateLimiter(*RATE_LIMITS.get(base_url, DEFAULT_RATE_LIMIT))
+        self.base_url = base_url
+        self.model = model
+        self.max_tokens = max_tokens
+        self.timeout = timeout
+        self.api_key = api_key          # 固定密钥 (如本地服务)
+        self.user_key = user_key        # 无固定密钥时是否使用用户的 DeepSeek Key
+        self.slow_after = timeout * slow_factor
+        self.latency = None             # 延迟 EWMA (秒)
+        self.slow_until = 0.0           # 降级到期时间：之后重新按预设顺序调用以刷新延迟
+        self.calls = 0
+        self.failures = 0               # 连续失败次数
+        self.down_until = 0.0
+        self.clients = {}
+        self.lock = threading.Lock()
+
+    def available(self):
+        return time.monotonic() >= self.down_until
+
+    def is_slow(self):
+        return self.latency is not None and self.latency > self.slow_after and time.monotonic() < self.slow_until
+
+    def key_for(self, api_key):
+        return self.api_key or (api_key if self.user_key else None)
+
+    def client(self, api_key):
+        key = self.key_for(api_key)
+        with self.lock:
+            if key not in self.clients:
+                from openai import OpenAI  # 延迟导入：仅在真正调用 LLM 时加载
+                self.clients[key] = OpenAI(api_key=key, base_url=self.base_url, timeout=self.timeout, max_retries=0)
+            return self.clients[key]
+
+    def complete(self, api_key, messages, temperature, priority=INTERACTIVE, owner=None, attempt=0):
+        reserved = sum(estimate_tokens(m["content"]) for m in messages) + self.max_tokens
+        self.limiter.acquire(reserved, priority, owner)
+        start = time.monotonic()
+        try:
+            response = self.client(api_key).chat.completions.create(
+                model=self.model, messages=messages, temperature=temperature, max_tokens=self.max_tokens
+            )
+        except Exception as e:
+            # 超时、连接错误、429 等均未产生 token：全额归还预留额度
+            self.limiter.refund(reserved)
+            if getattr(e, "status_code", None) == 429:
+                # 限流：整个提供方暂停到 Retry-After 之后，由路由器重试
+                self.limiter.pause(retry_after_seconds(e, attempt))
+                raise RateLimited(str(e)) from e
+            raise
+        elapsed = time.monotonic() - start
+        usage = getattr(response, "usage", None)
+        if usage is not None and usage.total_tokens:
+            self.limiter.refund(reserved - usage.total_tokens)
+        with self.lock:
+            self.calls += 1
+            self.failures = 0
+            self.latency = elapsed if self.latency is None else 0.7 * self.latency + 0.3 * elapsed
+            if self.latency > self.slow_after:
+                self.slow_until = time.monotonic() + SLOW_PROBE_INTERVAL
+        return response.choices[0].message.content
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= 2:
+                # 连续失败：指数退避熔断，最长 5 分钟
+                self.down_until = time.monotonic() + min(300, 10 * 2 ** (self.failures - 2))
+
+def create_llm_backends():
+    # 同一提供方的后端共享一个令牌桶
+    limiters = {}
+    for spec in LLM_PROVIDERS.values():
+        if spec["base_url"] not in limiters:
+            limiters[spec["base_url"]] = RateLimiter(*RATE_LIMITS.get(spec["base_url"], DEFAULT_RATE_LIMIT))
+    return {name: LLMBackend(name, limiter=limiters[spec["base_url"]], **spec) for name, spec in LLM_PROVIDERS.items()}
+
+def reachable_backends(routing, api_key):
+    # 路由链中可调用的后端：自带固定密钥 (如本地服务)，或用户已填写 DeepSeek Key
+    names = LLM_ROUTING[routing]["routine"] + LLM_ROUTING[routing]["pivotal"]
+    return sorted({name for name in names
+                   if LLM_PROVIDERS[name].get("api_key") or (api_key and LLM_PROVIDERS[name].get("user_key", True))})
+
+class LLMRouter:
+    def __init__(self, routing, backends, owner=None, priority=INTERACTIVE, rate_limit_retries=4):
+        self.routine = [backends[name] for name in LLM_ROUTING[routing]["routine"]]
+        self.pivotal = [backends[name] for name in LLM_ROUTING[routing]["pivotal"]]
+        self.owner = owner
+        self.priority = priority
+        self.rate_limit_retries = rate_limit_retries
+
+    def usable(self, api_key):
+        return any(backend.key_for(api_key) for backend in self.routine + self.pivotal)
+
+    def complete(self, api_key, messages, temperature, pivotal=False):
+        # 跳过没有可用密钥的后端；熔断中或过慢的后端排到链尾 (稳定排序保留预设优先级)
+        chain = [b for b in (self.pivotal if pivotal else self.routine) if b.key_for(api_key)]
+        chain = sorted(chain, key=lambda b: (not b.available(), b.is_slow()))
+        errors = [] if chain else ["路由链中没有可用密钥的后端"]
+        for backend in chain:
+            for attempt in range(self.rate_limit_retries + 1):
+                try:
+                    return backend.complete(api_key, messages, temperature, self.priority, self.owner, attempt), backend.name
+                except RateLimited as e:
+                    # 429 不计入健康失败：等待令牌桶恢复后在同一后端重试
+                    last = e
+                    continue
+                except Exception as e:
+                    backend.record_failure()
+                    errors.append(f"{backend.name}: {e}")
+                    break
+            else:
+                errors.append(f"{backend.name}: {last}")
+        raise RuntimeError(" | ".join(errors))
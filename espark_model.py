@@ -0,0 +1,167 @@
+# ==============================================================================
+# Espark 仿真内核：有界记忆 + 战略智能体 (mesa)，仅在推演运行时导入
+# ==============================================================================
+import json
+import mesa
+from espark_llm import LLMRouter, create_llm_backends, estimate_tokens
+
+class AgentMemory:
+    """有界记忆：最近 window 年原文 + 周期压缩摘要，提示词长度不随推演年数增长。"""
+    def __init__(self, window=5, summary_every=5, max_summaries=3, max_tokens=400):
+        self.window = window
+        self.summary_every = summary_every
+        self.max_summaries = max_summaries
+        self.max_tokens = max_tokens
+        self.recent = []     # 最近 window 条原始决策记录
+        self.pending = []    # 已移出窗口、等待压缩的记录
+        self.summaries = []  # 压缩摘要 {start, end, shifts, note}
+        self.last_code = 0   # 上一段摘要末尾的政策阶段，用于识别跨段转折
+
+    def add(self, record):
+        self.recent.append(record)
+        if len(self.recent) > self.window:
+            self.pending.append(self.recent.pop(0))
+        if len(self.pending) >= self.summary_every:
+            self.summaries.append(self._summarize(self.pending, self.last_code))
+            self.last_code = self.pending[-1]["Policy_Code"]
+            self.pending = []
+        while len(self.summaries) > self.max_summaries:
+            a, b = self.summaries.pop(0), self.summaries.pop(0)
+            self.summaries.insert(0, {"start": a["start"], "end": b["end"], "shifts": a["shifts"] + b["shifts"], "note": b["note"]})
+
+    @staticmethod
+    def _summarize(records, prev_code):
+        # 政策阶段单调递增，因此 shifts 总数最多 3 条，摘要大小有上界
+        codes = [prev_code] + [r["Policy_Code"] for r in records]
+        shifts = [(r["Year"], r["Policy"]) for prev, r in zip(codes, records) if r["Policy_Code"] != prev]
+        return {"start": records[0]["Year"], "end": records[-1]["Year"], "shifts": shifts,
+                "note": f"{records[-1]['Policy']} | 劳动力{records[-1]['Labor_Lag']}"}
+
+    def render(self, thought_chars=40):
+        lines = []
+        for sm in self.summaries + ([self._summarize(self.pending, self.last_code)] if self.pending else []):
+            shifts = "，".join(f"{y}年转为{p}" for y, p in sm["shifts"]) or "政策维持"
+            lines.append(f"[{sm['start']}-{sm['end']}] {shifts}；期末: {sm['note']}")
+        recent = list(self.recent)
+        while True:
+            text = "\n".join(lines + [f"{r['Year']}: {r['Policy']} | {r['Thought'][:thought_chars]}" for r in recent])
+            if estimate_tokens(text) <= self.max_tokens:
+                return text
+            # 超出上限：先截短思维链，再丢弃最旧的原文记录，最后丢弃最旧的摘要
+            if thought_chars > 10: thought_chars //= 2
+            elif recent: recent.pop(0)
+            elif lines: lines.pop(0)
+            else: return ""
+
+    def state(self):
+        return {"config": (self.window, self.summary_every, self.max_summaries, self.max_tokens), "last_code": self.last_code,
+                "recent": list(self.recent), "pending": list(self.pending), "summaries": list(self.summaries)}
+
+    @classmethod
+    def from_state(cls, state):
+        mem = cls(*state["config"])
+        mem.last_code = state["last_code"]
+        mem.recent, mem.pending, mem.summaries = list(state["recent"]), list(state["pending"]), list(state["summaries"])
+        return mem
+
+class StrategicAgent(mesa.Agent):
+    def __init__(self, unique_id, model):
+        super().__init__(unique_id, model)
+        self.policy_stage = 0 
+        self.policy_names = ["严格一孩", "试点(双独/单独)", "全面二孩", "三孩及配套"]
+        self.memory = AgentMemory(max_tokens=model.memory_tokens)  # 有界记忆 (随快照保存)
+        
+    def step(self):
+        year = self.model.year
+        current_pol = self.policy_names[self.policy_stage]
+        economy_context = self.model.get_economic_context(year)
+        labor_status = self.model.get_labor_supply_status(year)
+        grassroots = self.model.get_grassroots_feedback(year)
+        
+        thought = "模拟推演中..."
+        error = None  # 本步 LLM 调用失败原因 (结构化记录，供缓存等下游判断)
+        new_stage = self.policy_stage
+
+        if self.model.llm.usable(self.model.api_key):
+            try:
+                if year % 2 == 0 or year > 2010:
+                    user_prompt = f"""
+                    【年份】{year} 【国策】{current_pol}
+                    【情报】经济:{economy_context} | 劳动力:{labor_status} | 基层:{grassroots}
+                    【记忆】{self.memory.render() or "无"}
+                    【任务】决定明年政策(0-3)。
+                    【输出JSON】{{"thought": "...", "decision_code": int}}
+                    """
+                    content, _ = self.model.llm.complete(
+                        self.model.api_key,
+                        [{"role": "system", "content": self.model.system_prompt}, {"role": "user", "content": user_prompt}],
+                        self.model.temperature, pivotal=self.model.is_pivotal_year(year)
+                    )
+                    content = content.replace("```json", "").replace("```", "").strip()
+                    result = json.loads(content)
+                    new_stage = int(result["decision_code"])
+                    thought = result["thought"]
+            except Exception as e:
+                error = str(e)
+                thought = f"AI Error: {e}"
+        else:
+            if year >= 2013 and self.policy_stage == 0: new_stage = 1; thought = "[模拟] 劳动力拐点显现，启动试点。"
+            elif year >= 2016 and self.policy_stage == 1: new_stage = 2; thought = "[模拟] 全面二孩时刻。"
+            elif year >= 2021 and self.policy_stage == 2: new_stage = 3; thought = "[模拟] 三孩时代。"
+
+        if new_stage > self.policy_stage: self.policy_stage = new_stage
+        
+        record = {"Year": year, "Policy": self.policy_names[self.policy_stage], "Policy_Code": self.policy_stage, 
+                  "Economy": economy_context, "Labor_Lag": labor_status, "Thought": thought, "Error": error}
+        self.memory.add(record)
+        return record
+
+class StrategicModel(mesa.Model):
+    def __init__(self, api_key, system_prompt, temperature, start_year, memory_tokens=400, llm=None):
+        super().__init__()
+        self.api_key = api_key
+        self.llm = llm or LLMRouter("仅 DeepSeek Chat", create_llm_backends())
+        self.system_prompt = system_prompt
+        self.temperature = temperature
+        self.memory_tokens = memory_tokens
+        self.year = start_year
+        self.agent = StrategicAgent("Gov", self)
+
+    def get_economic_context(self, year):
+        if year < 2000: return "经济起飞期"
+        elif year < 2010: return "WTO黄金期"
+        elif year < 2015: return "新常态转折点"
+        else: return "高质量发展期"
+
+    def get_labor_supply_status(self, year):
+        birth_year = year - 20
+        if birth_year < 1975: return "充沛"
+        elif birth_year < 1990: return "充足"
+        else: return "严重短缺"
+
+    def get_grassroots_feedback(self, year):
+        return "执行难度大" if year < 2000 else "群众意愿低迷"
+
+    def is_pivotal_year(self, year):
+        # 关键年份：经济或劳动力态势换挡，或上一年刚发生政策跃迁
+        memory = self.agent.memory.recent
+        return (self.get_economic_context(year) != self.get_economic_context(year - 1)
+                or self.get_labor_supply_status(year) != self.get_labor_supply_status(year - 1)
+                or (len(memory) >= 2 and memory[-1]["Policy_Code"] != memory[-2]["Policy_Code"]))
+
+    def step(self):
+        res = self.agent.step()
+        self.year += 1
+        return res
+
+    # --- 检查点：每步前保存轻量快照，可从任意年份分叉/续跑 ---
+    def snapshot(self):
+        return {"year": self.year, "policy_stage": self.agent.policy_stage, "memory": self.agent.memory.state()}
+
+    @classmethod
+    def from_snapshot(cls, api_key, system_prompt, temperature, snap, llm=None):
+        memory = AgentMemory.from_state(snap["memory"])
+        model = cls(api_key, system_prompt, temperature, snap["year"], memory.max_tokens, llm)
+        model.agent.policy_stage = snap["policy_stage"]
+        model.agent.memory = memory
+        return model
@@ -0,0 +1,158 @@
+import threading
+import time
+
+import espark_llm
+from espark_llm import LLMRouter, create_llm_backends, reachable_backends
+
+LOCAL = "本地模型 (OpenAI 兼容)"
+LOCAL_FIRST = "本地优先 (DeepSeek 兜底)"
+
+
+class StubCompletions:
+    def __init__(self, backend_name, calls):
+        self.backend_name, self.calls = backend_name, calls
+
+    def create(self, **kwargs):
+        self.calls.append(self.backend_name)
+        message = type("Message", (), {"content": '{"thought": "ok", "decision_code": 0}'})
+        choice = type("Choice", (), {"message": message})
+        return type("Response", (), {"choices": [choice], "usage": None})
+
+
+def configure_local(monkeypatch):
+    # 模拟设置了 ESPARK_LOCAL_LLM_URL 的部署
+    monkeypatch.setitem(espark_llm.LLM_PROVIDERS, LOCAL, dict(espark_llm.LLM_PROVIDERS[LOCAL], api_key="EMPTY"))
+
+
+def stub_backends(calls):
+    backends = create_llm_backends()
+    for backend in backends.values():
+        chat = type("Chat", (), {"completions": StubCompletions(backend.name, calls)})
+        backend.client = lambda api_key, chat=chat: type("Client", (), {"chat": chat})
+    return backends
+
+
+def test_unconfigured_local_backend_keeps_rule_based_default():
+    backends = create_llm_backends()
+    assert not LLMRouter("自动路由 (常规→Chat，关键年→Reasoner)", backends).usable("")
+    assert not LLMRouter(LOCAL_FIRST, backends).usable("")
+    # DeepSeek Key 不会被发往本地服务
+    assert reachable_backends(LOCAL_FIRST, "sk-user") == ["DeepSeek Chat"]
+
+
+def test_local_backend_usable_without_deepseek_key(monkeypatch):
+    configure_local(monkeypatch)
+    backends = create_llm_backends()
+    assert LLMRouter(LOCAL_FIRST, backends).usable("")
+    assert not LLMRouter("仅 DeepSeek Chat", backends).usable("")
+    assert reachable_backends(LOCAL_FIRST, "") == [LOCAL]
+
+
+def test_router_skips_backends_without_key(monkeypatch):
+    configure_local(monkeypatch)
+    calls = []
+    router = LLMRouter(LOCAL_FIRST, stub_backends(calls))
+    # 关键年链以 DeepSeek 开头，但没有 Key 时应直接使用本地模型
+    _, used = router.complete("", [{"role": "user", "content": "hi"}], 0.3, pivotal=True)
+    assert used == LOCAL
+    assert calls == [LOCAL]
+
+
+class RateLimitError(Exception):
+    status_code = 429
+
+    def __init__(self, headers):
+        super().__init__("429 Too Many Requests")
+        self.response = type("Response", (), {"headers": headers})
+
+
+def test_retry_after_parsing_falls_back_on_malformed_headers():
+    assert espark_llm.retry_after_seconds(RateLimitError({"retry-after": "2"}), 0) == 2.0
+    assert espark_llm.retry_after_seconds(RateLimitError({"retry-after-ms": "1500"}), 0) == 1.5
+    for headers in ({"retry-after": "soon"}, {"retry-after-ms": "abc"}, {"retry-after": "inf"}, {}):
+        assert espark_llm.retry_after_seconds(RateLimitError(headers), 3) == 8.0
+
+
+def test_failed_request_refunds_token_reservation():
+    backend = create_llm_backends()["DeepSeek Chat"]
+
+    def fail(**kwargs):
+        raise TimeoutError("timed out")
+
+    completions = type("Completions", (), {"create": staticmethod(fail)})
+    backend.client = lambda api_key: type("Client", (), {"chat": type("Chat", (), {"completions": completions})})
+    before = backend.limiter.tokens
+    try:
+        backend.complete("sk-user", [{"role": "user", "content": "hi"}], 0.3)
+    except TimeoutError:
+        pass
+    assert backend.limiter.tokens >= before - 1  # 仅允许补充时间带来的微小浮动
+
+
+def test_slow_backend_is_probed_again_after_demotion():
+    calls = []
+    backends = stub_backends(calls)
+    reasoner = backends["DeepSeek Reasoner"]
+    router = LLMRouter("自动路由 (常规→Chat，关键年→Reasoner)", backends)
+    messages = [{"role": "user", "content": "hi"}]
+    # 一次过慢的推理调用：降级期内关键年改用 Chat
+    reasoner.latency = 35.0
+    reasoner.slow_until = espark_llm.time.monotonic() + espark_llm.SLOW_PROBE_INTERVAL
+    assert router.complete("sk-user", messages, 0.3, pivotal=True)[1] == "DeepSeek Chat"
+    # 降级到期后重新探测 Reasoner，快速响应使延迟回落到阈值以下
+    reasoner.slow_until = 0.0
+    assert router.complete("sk-user", messages, 0.3, pivotal=True)[1] == "DeepSeek Reasoner"
+    assert reasoner.latency < reasoner.slow_after
+    assert router.complete("sk-user", messages, 0.3, pivotal=True)[1] == "DeepSeek Reasoner"
+    assert calls == ["DeepSeek Chat", "DeepSeek Reasoner", "DeepSeek Reasoner"]
+
+
+def served_order(limiter, requests, spacing=0.02):
+    # 令牌桶耗尽后依次排队，按放行顺序记录 (owner, priority)
+    limiter.requests = 0.0
+    order, threads = [], []
+    for owner, priority in requests:
+        t = threading.Thread(target=lambda o=owner, p=priority: (limiter.acquire(1, p, o), order.append(o)))
+        t.start()
+        threads.append(t)
+        time.sleep(spacing)
+    for t in threads:
+        t.join()
+    return order
+
+
+def test_interactive_requests_are_served_before_batch():
+    order = served_order(espark_llm.RateLimiter(240, 10 ** 6),
+                         [("batch", espark_llm.BATCH)] * 2 + [("live", espark_llm.INTERACTIVE)] * 2)
+    assert order == ["live", "live", "batch", "batch"]
+
+
+def test_sessions_are_served_round_robin():
+    order = served_order(espark_llm.RateLimiter(240, 10 ** 6), [("A", espark_llm.BATCH)] * 3 + [("B", espark_llm.BATCH)] * 3)
+    assert order == ["A", "B", "A", "B", "A", "B"]
+
+
+def test_rate_limit_pauses_provider_and_retries_same_backend(monkeypatch):
+    monkeypatch.setitem(espark_llm.RATE_LIMITS, "https://api.deepseek.com", (600, 10 ** 6))
+    calls = []
+    backends = stub_backends(calls)
+    chat = backends["DeepSeek Chat"]
+    ok = chat.client("sk-user")
+
+    def create(**kwargs):
+        if not calls:
+            calls.append("429")
+            raise RateLimitError({"retry-after-ms": "300"})
+        return ok.chat.completions.create(**kwargs)
+
+    completions = type("Completions", (), {"create": staticmethod(create)})
+    chat.client = lambda api_key: type("Client", (), {"chat": type("Chat", (), {"completions": completions})})
+    start = time.monotonic()
+    _, used = LLMRouter("仅 DeepSeek Chat", backends).complete("sk-user", [{"role": "user", "content": "hi"}], 0.3)
+    assert used == "DeepSeek Chat"
+    assert calls == ["429", "DeepSeek Chat"]
+    assert time.monotonic() - start >= 0.3   # 重试等待了 Retry-After
+    assert chat.failures == 0                # 429 不触发熔断
+    # 同一提供方的其他模型共享令牌桶，暂停对其同样生效
+    assert backends["DeepSeek Reasoner"].limiter is chat.limiter
+    assert chat.limiter.paused_until > start
@@ -0,0 +1,103 @@
+import json
+
+from espark_model import StrategicModel
+
+
+class StubRouter:
+    """按顺序返回预设决策的假路由器，不发起任何网络请求。"""
+    def __init__(self, decisions):
+        self.decisions = list(decisions)
+        self.calls = []
+
+    def usable(self, api_key):
+        return True
+
+    def complete(self, api_key, messages, temperature, pivotal=False):
+        self.calls.append(messages)
+        return json.dumps(self.decisions.pop(0), ensure_ascii=False), "stub"
+
+
+def test_llm_step_applies_decision():
+    router = StubRouter([{"thought": "提前放开", "decision_code": 2}])
+    model = StrategicModel("key", "prompt", 0.3, 1990, llm=router)
+    row = model.step()
+    assert row["Thought"] == "提前放开"
+    assert row["Policy_Code"] == 2
+    assert model.year == 1991
+    assert len(router.calls) == 1
+
+
+def test_llm_prompt_includes_memory():
+    # 2010 年前只在偶数年调用 LLM：1990、1992
+    router = StubRouter([{"thought": "第一次决策", "decision_code": 0}, {"thought": "第二次决策", "decision_code": 0}])
+    model = StrategicModel("key", "prompt", 0.3, 1990, llm=router)
+    for _ in range(3):
+        model.step()
+    assert len(router.calls) == 2
+    assert "第一次决策" in router.calls[-1][1]["content"]
+
+
+def test_rule_based_path_without_llm():
+    model = StrategicModel("", "prompt", 0.3, 1990)  # 默认路由仅 DeepSeek，无 Key 即走规则模拟
+    rows = [model.step() for _ in range(35)]
+    switches = [cur["Year"] for prev, cur in zip(rows, rows[1:]) if cur["Policy_Code"] != prev["Policy_Code"]]
+    assert switches == [2013, 2016, 2021]
+
+
+class FailingRouter:
+    def usable(self, api_key):
+        return True
+
+    def complete(self, api_key, messages, temperature, pivotal=False):
+        raise RuntimeError("401 Unauthorized")
+
+
+def test_llm_failure_is_reported_in_error_field():
+    model = StrategicModel("bad-key", "prompt", 0.3, 1990, llm=FailingRouter())
+    row = model.step()
+    assert row["Error"] == "401 Unauthorized"
+    assert row["Policy_Code"] == 0
+    assert model.step()["Error"] is None  # 1991 年不调用 LLM
+
+
+def run_with_checkpoints(model, years):
+    # 与 ES3.SimulationJob.run 相同：每步前保存快照
+    rows, checkpoints = [], []
+    for _ in range(years):
+        checkpoints.append(model.snapshot())
+        rows.append(model.step())
+    return rows, checkpoints
+
+
+def plain(value):
+    # 落盘 (JSON) 后元组会变成列表
+    return json.loads(json.dumps(value, ensure_ascii=False))
+
+
+def test_fork_matches_parent_at_fork_year():
+    parent_rows, parent_checkpoints = run_with_checkpoints(StrategicModel("", "prompt", 0.3, 1990), 40)
+    idx = 32  # 2022 年：记忆中已有含政策转折的摘要
+    fork = StrategicModel.from_snapshot("", "prompt", 0.3, parent_checkpoints[idx])
+    assert fork.year == parent_rows[idx]["Year"] == 2022
+    assert fork.agent.memory.summaries and fork.agent.memory.summaries[-1]["shifts"]
+    assert fork.agent.memory.state() == parent_checkpoints[idx]["memory"]
+    rows, checkpoints = run_with_checkpoints(fork, 40 - idx)
+    # 分叉 = 父推演前缀 + 从检查点重算的后缀，与父推演逐行一致
+    assert parent_rows[:idx] + rows == parent_rows
+    assert parent_checkpoints[:idx] + checkpoints == parent_checkpoints
+
+
+def test_fork_from_json_round_tripped_snapshot():
+    parent = StrategicModel("", "prompt", 0.3, 1990)
+    parent_rows, parent_checkpoints = run_with_checkpoints(parent, 35)
+    idx = 32
+    stored = plain(parent_checkpoints[idx])
+    fork = StrategicModel.from_snapshot("", "prompt", 0.3, stored)
+    original = StrategicModel.from_snapshot("", "prompt", 0.3, parent_checkpoints[idx])
+    assert fork.agent.memory.render() == original.agent.memory.render()
+    rows, _ = run_with_checkpoints(fork, 35 - idx)
+    assert rows == parent_rows[idx:]
+    # 从末年之后的状态续跑 (final_state 同样经 JSON 存储)
+    resumed = StrategicModel.from_snapshot("", "prompt", 0.3, plain(parent.snapshot()))
+    longer_rows, _ = run_with_checkpoints(StrategicModel("", "prompt", 0.3, 1990), 40)
+    assert run_with_checkpoints(resumed, 5)[0] == longer_rows[35:]